@@ -4,18 +4,28 @@ Based on bza.py (Blazemeter API client) module, and adopted as-is for NewRelic A
 
 import copy
 import datetime
+import email.utils
+import gzip
+import hashlib
+import json
 import logging
 import os
+import queue
+import random
+import string
 import sys
+import threading
 import time
-import traceback
 import uuid
+from collections import deque
 from functools import wraps
 from ssl import SSLError
 from urllib.error import URLError
 
 import bzt.engine
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ReadTimeout
 
 from bzt import TaurusInternalException, TaurusNetworkError, TaurusConfigError
@@ -25,13 +35,47 @@ from bzt.modules.aggregator import DataPoint, KPISet, ResultsProvider, Aggregato
 from bzt.utils import open_browser
 from bzt.utils import dehumanize_time
 
-from newrelic_telemetry_sdk import GaugeMetric, MetricClient
-from python_graphql_client import GraphqlClient
-
 NETWORK_PROBLEMS = (IOError, URLError, SSLError, ReadTimeout, TaurusNetworkError)
+DEFAULT_DASHBOARD_URL = 'https://one.newrelic.com/dashboards'
+KPI_BUFFER_LIMIT = 10000  # datapoints waiting for the sending thread, new ones are dropped on overflow
+RETRY_QUEUE_LIMIT = 100  # failed metric batches waiting for retry, the oldest are dropped first
+
+# metric names for percentile keys ("50.0" -> "bztp50.0"), filled on first use
+_PCT_NAME = {}
+_PCTC_NAME = {}
+
+
+class DataRejectedError(TaurusNetworkError):
+    """ API refused the data itself (4xx), sending the same data again won't help """
+
+
+def backoff_delay(attempt, base, cap):
+    """ Exponential backoff with full jitter: random delay in [0, min(cap, base * 2^attempt)] """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_delay(value):
+    """ Seconds to wait by Retry-After header value (delta-seconds or HTTP-date), None if it's absent or broken """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
 
 
 def send_with_retry(method):
+    """
+    On network failure the call is queued to be repeated by the sending thread after a backoff delay,
+    instead of sleeping until the API recovers.
+    """
     @wraps(method)
     def _impl(self, *args, **kwargs):
         if not isinstance(self, NewRelicUploader):
@@ -39,16 +83,12 @@ def send_with_retry(method):
 
         try:
             method(self, *args, **kwargs)
-        except (IOError, TaurusNetworkError):
-            self.log.debug("Error sending data: %s", traceback.format_exc())
-            self.log.warning("Failed to send data, will retry in %s sec...", self._session.timeout)
-            try:
-                time.sleep(self._session.timeout)
-                method(self, *args, **kwargs)
-                self.log.info("Succeeded with retry")
-            except NETWORK_PROBLEMS:
-                self.log.error("Fatal error sending data: %s", traceback.format_exc())
-                self.log.warning("Will skip failed data and continue running")
+        except DataRejectedError as exc:
+            self.log.error("%s, skipping data", exc)
+            self._dpoint_serializer.forget_cumulative()
+        except NETWORK_PROBLEMS:
+            self.log.debug("Error sending data", exc_info=True)
+            self._schedule_retry(method, args, kwargs, 0)
 
     return _impl
 
@@ -56,72 +96,96 @@ def send_with_retry(method):
 class Session(object):
     def __init__(self):
         super(Session, self).__init__()
-        self.metric_client = None
+        self.metric_endpoint = 'https://metric-api.newrelic.com/metric/v1'
         self.dashboard_url = 'https://onenr.io/PLACEHOLDER'
 
         self.timeout = 30
         self.logger_limit = 256
         self.token = None
         self.token_file = None
+        self.min_token_len = 20  # license and insert keys are 32+ chars
+        self.compress_threshold = 1024  # bytes, smaller payloads are sent as is
         self.log = logging.getLogger(self.__class__.__name__)
         self.http_session = requests.Session()
-        self._retry_limit = 5
+        self.http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.failure_limit = 5  # failed sends in a row before sends are paused
+        self.cooldown = 60  # sec to skip sends after failure_limit is reached
+        self._failures = 0
+        self._cooldown_until = 0
         self.uuid = None
 
     def client_init(self):
-        try:
-            self.metric_client = MetricClient(self.token)
-
-        except Exception:
-            self.log.error('Error in NR Client initialization: %s', traceback.format_exc())
-            self.log.info('Exiting...')
-            exit(0)
+        self.http_session.headers.update({
+            'Api-Key': self.token,
+            'Content-Type': 'application/json'
+        })
 
-    def _request(self, data=None, headers=None, method=None, raw_result=False, retry=True):
+    def _request(self, data=None, headers=None, method=None, raw_result=False):
         """
-        :type data: Union[dict,str]
+        Single attempt to send, retries are up to send_with_retry
+        :type data: bytes
         :param headers: dict
         :param method: str
-        :return: dict
         """
-        retry_limit = self._retry_limit
+        headers = dict(headers or {})
+        if len(data) > self.compress_threshold:
+            data = gzip.compress(data, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
 
-        while True:
-            try:
-                response = self.metric_client.send_batch(data)
-                response.raise_for_status()
-                self.log.debug("Status code from API: %d", response.status)
-            except BaseException:
-                if retry and retry_limit:
-                    retry_limit -= 1
-                    self.log.warning("Problem with API, connectivity. Retry...")
-                    continue
-                raise
-            break
-
-        return 0
+        try:
+            response = self.http_session.post(self.metric_endpoint, data=data, headers=headers, timeout=self.timeout)
+        except requests.RequestException as exc:
+            self._count_failure()
+            raise TaurusNetworkError("Failed to send data to NewRelic API: %s" % exc)
+
+        status = response.status_code
+        self.log.debug("Status code from API: %d", status)
+        if 400 <= status < 500 and status not in (408, 429):
+            raise DataRejectedError("NewRelic API rejected data: HTTP status code %d" % status)
+
+        if status >= 300:
+            retry_after = retry_after_delay(response.headers.get('Retry-After'))
+            if retry_after:
+                self._cooldown_until = max(self._cooldown_until, time.time() + retry_after)
+                self.log.warning("API asked to retry after %.1f sec", retry_after)
+            self._count_failure()
+            raise TaurusNetworkError("Failed to send data to NewRelic API: HTTP status code %d" % status)
+
+        self._failures = 0
+
+    def _count_failure(self):
+        """ Pause sends for a while when API fails failure_limit times in a row """
+        self._failures += 1
+        if self._failures >= self.failure_limit:
+            self._failures = 0
+            self._cooldown_until = max(self._cooldown_until, time.time() + self.cooldown)
+            self.log.warning("API is failing, pausing sends for %s sec", self.cooldown)
+
+    def cooldown_left(self):
+        """ Seconds left until sends are allowed again (by Retry-After or after repeated failures) """
+        return max(0.0, self._cooldown_until - time.time())
 
     def ping(self):
-        """ Quick check if we can access the service """
-        result = self.metric_client.send({})
-        if result.status >= 300:
-            raise Exception('HTTP status code from API is not 2xx, check access permissions or firewall settings',
-                            result.status)
+        """
+        Quick local check of the ingest key, without a network round trip:
+        connectivity and access are verified by the first data send, which is retried anyway
+        """
+        if not self.token or len(self.token.strip()) < self.min_token_len:
+            raise TaurusConfigError("NewRelic Ingest key looks malformed, check token settings")
 
     def send_kpi_data(self, data, is_check_response=True, submit_target=None):
         """
         Sends online data
 
         """
-        response = self._request(data)
+        if self.cooldown_left():
+            raise TaurusNetworkError("Sending to NewRelic API is paused, %.1f sec left" % self.cooldown_left())
 
-        if response != 0:
-            self.log.error("Response incorrect - %d, exiting... ", response)
-            exit(1)
+        self._request(data)
 
     def client_close(self):
         self.log.debug("Closing NewRelic client...")
-        self.metric_client.close()
+        self.http_session.close()
 
 
 class NewRelicUploader(Reporter, AggregatorListener, Singletone):
@@ -143,79 +207,61 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         self.project = 'myproject'
         self.custom_tags = {}
         self.additional_tags = {}
-        self.kpi_buffer = []
+        self._kpi_queue = queue.Queue(maxsize=KPI_BUFFER_LIMIT)
+        self._worker = None
+        self._stop_deadline = 0
         self.send_interval = 5
-        self.last_dispatch = 0
+        self.retry_attempts = 3
+        self.retry_base_delay = 1
+        self.retry_max_delay = 30
+        self._retry_queue = deque(maxlen=RETRY_QUEUE_LIMIT)
+        self._next_retry_ts = 0
         self.results_url = None
         self._session = None
         self.first_ts = sys.maxsize
         self.last_ts = 0
         self.dashboard_generator_on = False
-        self.dashboard_url = 'https://one.newrelic.com/dashboards'  # default URL
+        self.dashboard_url = DEFAULT_DASHBOARD_URL
 
         self._dpoint_serializer = DatapointSerializerNF(self)
         self.log = logging.getLogger(self.__class__.__name__)
 
     def token_processor(self):
+        return self._read_token("Token", "token", 'NEW_RELIC_INSERT_KEY', "token-file")
+
+    def api_token_processor(self):
+        return self._read_token("API token", "api-token", 'NEW_RELIC_API_KEY', "api-token-file")
+
+    def _read_token(self, title, option, env_var, file_option):
         # Read from config file
-        token = self.settings.get("token", "")
+        token = self.settings.get(option, "")
         if token:
-            self.log.info("Token found in config file")
+            self.log.info("%s found in config file", title)
             return token
-        self.log.info("Token not found in config file")
+        self.log.info("%s not found in config file", title)
+
         # Read from environment
-        try:
-            token = os.environ['NEW_RELIC_INSERT_KEY']
-            self.log.info("Token found in NEW_RELIC_INSERT_KEY environment variable")
+        token = os.environ.get(env_var)
+        if token:
+            self.log.info("%s found in %s environment variable", title, env_var)
             return token
-        except BaseException:
-            self.log.info("Token not found in NEW_RELIC_INSERT_KEY environment variable")
-            pass
-            # Read from file
-            token_file = self.settings.get("token-file", "")
-            if token_file:
-                try:
-                    with open(token_file, 'r') as handle:
-                        token = handle.read().strip()
-                        self.log.info("Token found in file %s:", token_file)
-                        return token
-                except BaseException:
-                    self.log.info("Token can't be retrieved from file: %s, please check path or access", token_file)
-            else:
-                self.log.info("Parameter token_file is empty or doesn't exist")
+        self.log.info("%s not found in %s environment variable", title, env_var)
 
-        return None
+        # Read from file
+        token_file = self.settings.get(file_option, "")
+        if not token_file:
+            self.log.info("Parameter %s is empty or doesn't exist", file_option)
+            return None
 
-    # TODO: deduplicate
-    def api_token_processor(self):
-        # Read from config file
-        api_token = self.settings.get("api-token", "")
-        if api_token:
-            self.log.info("API token found in config file")
-            return api_token
-        self.log.info("API token not found in config file")
-        # Read from environment
         try:
-            api_token = os.environ['NEW_RELIC_API_KEY']
-            self.log.info("Token found in NEW_RELIC_API_KEY environment variable")
-            return api_token
-        except BaseException:
-            self.log.info("API token not found in NEW_RELIC_API_KEY environment variable")
-            pass
-            # Read from file
-            api_token_file = self.settings.get("api-token-file", "")
-            if api_token_file:
-                try:
-                    with open(api_token_file, 'r') as handle:
-                        api_token = handle.read().strip()
-                        self.log.info("Token found in file %s:", api_token_file)
-                        return api_token
-                except BaseException:
-                    self.log.info("Token can't be retrieved from file: %s, please check path or access", api_token_file)
-            else:
-                self.log.info("Parameter api_token_file is empty or doesn't exist")
+            with open(token_file, 'r') as handle:
+                token = handle.read().strip()
+        except OSError:
+            self.log.info("%s can't be retrieved from file: %s, please check path or access", title, token_file)
+            return None
 
-        return None
+        self.log.info("%s found in file %s", title, token_file)
+        return token
 
     def prepare(self):
         """
@@ -224,9 +270,13 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         super(NewRelicUploader, self).prepare()
         self.send_interval = dehumanize_time(self.settings.get("send-interval", self.send_interval))
         self.browser_open = self.settings.get("browser-open", self.browser_open)
+        self.retry_attempts = self.settings.get("retry-attempts", self.retry_attempts)
+        self.retry_base_delay = dehumanize_time(self.settings.get("retry-base-delay", self.retry_base_delay))
+        self.retry_max_delay = dehumanize_time(self.settings.get("retry-max-delay", self.retry_max_delay))
         self.project = self.settings.get("project", self.project)
         self.custom_tags = self.settings.get("custom-tags", self.custom_tags)
         self._dpoint_serializer.multi = self.settings.get("report-times-multiplier", self._dpoint_serializer.multi)
+        self._dpoint_serializer.batch_size = self.settings.get("batch-size", self._dpoint_serializer.batch_size)
 
         #### Dashboard manager related settings: 
         self.static_report = self.settings.get("static-report", 'false')
@@ -246,6 +296,7 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         self._dashboard = DashboardManager()
         self._dashboard.api_token = api_token
         self._dashboard.account_id = self.account_id
+        self._dashboard.cache_ttl = dehumanize_time(self.settings.get("dashboard-cache-ttl", self._dashboard.cache_ttl))
         self._dashboard.client_init()
 
         if self.account_id == '':
@@ -267,7 +318,7 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         try:
             with open(self.dashboard_template_path, 'r', encoding='utf-8') as template:
                 self.log.info('Using existing template from %s' % self.dashboard_template_path)
-                self._dashboard.template = template.read()
+                self._dashboard.set_template(template.read())
         except FileNotFoundError as fnfe:
             self.log.warning('Problem with template file, %s' % fnfe)
             self.dashboard_generator_on = False
@@ -296,6 +347,7 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         self._session.client_init()
         self._session.dashboard_url = self.dashboard_url
         self._session.timeout = dehumanize_time(self.settings.get("timeout", self._session.timeout))
+        self._session.metric_endpoint = self.settings.get("metric-api-endpoint", self._session.metric_endpoint)
         try:
             self._session.ping()  # to check connectivity and auth
         except Exception:
@@ -304,6 +356,10 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         if isinstance(self.engine.aggregator, ResultsProvider):
             self.engine.aggregator.add_listener(self)
 
+        # serialization and sending are done off the engine thread
+        self._worker = threading.Thread(target=self._flush_loop, name="NewRelicUploader", daemon=True)
+        self._worker.start()
+
     def startup(self):
         """
         Initiate online test
@@ -322,19 +378,27 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         """
         Upload results if possible
         """
-        self.log.debug("KPI bulk buffer len in post-proc: %s", len(self.kpi_buffer))
         self.log.info("Sending remaining KPI data to server...")
-
-        # noinspection PyTypeChecker
-        self.__send_data(self.kpi_buffer, False, True)
-
-        self.kpi_buffer = []
+        if self._worker:
+            # wait out active Retry-After cooldown, then final batch and each pending retry may take a full request
+            send_time = max(self.send_interval, self._session.timeout)
+            budget = self._session.cooldown_left() + send_time * (2 + len(self._retry_queue))
+            self._stop_deadline = time.time() + self._session.timeout + budget
+            try:
+                # stop mark, worker sends what's left and exits
+                self._kpi_queue.put(None, timeout=self._session.timeout)
+            except queue.Full:
+                self.log.warning("Sending thread doesn't take KPI data, some data may be lost")
+            else:
+                self._worker.join(max(0, self._stop_deadline - time.time()))
+            if self._worker.is_alive():
+                self.log.warning("Sending of remaining KPI data isn't finished in time, some data may be lost")
 
         if self.browser_open in ('end', 'both'):
             open_browser(self.results_url)
 
         ### If permlink will fail on first step, we will generate at on last moment
-        if self.dashboard_generator_on:
+        if self.dashboard_generator_on and self.dashboard_url in (None, DEFAULT_DASHBOARD_URL):
             self.dashboard_url = self._dashboard.dashboard_link(self.project)
 
         self.log.info("Report link: %s", self.dashboard_url)
@@ -342,22 +406,98 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         if self.static_report:
             self._dashboard.create_pdf(self.time_start, time.time() * 1000)
 
+        if self._worker and self._worker.is_alive():
+            return  # daemon thread still uses the session, it'll go away with the process
+
         self._session.client_close()
 
-    def check(self):
+    def _flush_loop(self):
         """
-        Send data if any in buffer
+        Sending thread: collect datapoints from the queue and send them each send_interval
         """
-        self.log.debug("KPI bulk buffer len: %s", len(self.kpi_buffer))
-        if self.last_dispatch < (time.time() - self.send_interval):
-            self.last_dispatch = time.time()
-            if len(self.kpi_buffer):
+        buf = []
+        last_dpoint = None
+        last_dispatch = time.time()
+        finished = False
+        while not finished:
+            try:
+                dpoint = self._kpi_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+            else:
+                if dpoint is None:
+                    finished = True
+                    # server asked us to hold on, forced passes would drop everything otherwise
+                    time.sleep(min(self._session.cooldown_left(), max(0, self._stop_deadline - time.time())))
+                else:
+                    buf.append(dpoint)
+
+            if not finished and time.time() - last_dispatch < self.send_interval:
+                continue
+
+            last_dispatch = time.time()
+            data, buf = buf, []
+            if data:
+                last_dpoint = data[-1]
+            elif finished and last_dpoint is not None:
+                # final report carries every cumulative value, even if no new data came since the last send
+                final = DataPoint(last_dpoint[DataPoint.TIMESTAMP])
+                final[DataPoint.CUMULATIVE] = last_dpoint[DataPoint.CUMULATIVE]
+                data = [final]
+            try:
+                self._send_retries(force=finished)
                 # noinspection PyTypeChecker
-                self.__send_data(self.kpi_buffer)
-                self.kpi_buffer = []
-        return super(NewRelicUploader, self).check()
+                self.__send_data(data, not finished, finished)
+                if finished:
+                    self._send_retries(force=True)
+            except Exception:
+                self.log.exception("Failed to process KPI data")
+
+        if self._retry_queue:
+            self.log.warning("%s batches of KPI data can't be sent and will be skipped", len(self._retry_queue))
+            self._retry_queue.clear()
+
+    def _schedule_retry(self, method, args, kwargs, attempt):
+        if attempt >= self.retry_attempts:
+            self.log.error("Fatal error sending data after %s retries", self.retry_attempts)
+            self.log.warning("Will skip failed data and continue running")
+            # unchanged cumulative values are not sent again, and the skipped batch may be the only one with them
+            self._dpoint_serializer.forget_cumulative()
+            return
+
+        delay = backoff_delay(attempt, self.retry_base_delay, self.retry_max_delay)
+        delay = max(delay, self._session.cooldown_left())
+        self.log.warning("Failed to send data, will retry in %.1f sec...", delay)
+        if len(self._retry_queue) == self._retry_queue.maxlen:
+            self.log.warning("Too many batches of KPI data wait for retry, the oldest one is skipped")
+            self._dpoint_serializer.forget_cumulative()
+        self._retry_queue.append((method, args, kwargs, attempt))
+        # one timer for the whole queue, fresh failures must not cut backoff of the older ones short
+        self._next_retry_ts = max(self._next_retry_ts, time.time() + delay)
+
+    def _send_retries(self, force=False):
+        """
+        Repeat failed sends when their backoff delay is over
+        """
+        if not self._retry_queue or (not force and time.time() < self._next_retry_ts):
+            return
+
+        pending, self._retry_queue = self._retry_queue, deque(maxlen=RETRY_QUEUE_LIMIT)
+        while pending:
+            method, args, kwargs, attempt = pending.popleft()
+            try:
+                method(self, *args, **kwargs)
+                self.log.info("Succeeded with retry")
+            except DataRejectedError as exc:
+                self.log.error("%s, skipping data", exc)
+                self._dpoint_serializer.forget_cumulative()
+            except NETWORK_PROBLEMS:
+                self.log.debug("Error sending data", exc_info=True)
+                # API is still failing, keep the rest for the next round
+                self._schedule_retry(method, args, kwargs, attempt + 1)
+                self._retry_queue.extend(pending)
+                return
 
-    @send_with_retry
     def __send_data(self, data, do_check=True, is_final=False):
 
         """
@@ -365,8 +505,15 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         """
 
         self.log.debug("Length of data to serialize: %d", len(data))
-        serialized = self._dpoint_serializer.get_kpi_body(data, self.additional_tags, is_final)
+        for batch in self._dpoint_serializer.iter_kpi_batches(data, is_final):
+            self.__send_batch(self._dpoint_serializer.to_json(batch, self.additional_tags), do_check)
 
+    @send_with_retry
+    def __send_batch(self, serialized, do_check=True):
+        """
+        Send one batch of metrics, failed batch is retried alone
+        :type serialized: bytes
+        """
         self._session.send_kpi_data(serialized, do_check)
 
     def aggregated_second(self, data: DataPoint):
@@ -374,7 +521,10 @@ class NewRelicUploader(Reporter, AggregatorListener, Singletone):
         Send online data
         :type data: DataPoint
         """
-        self.kpi_buffer.append(data)
+        try:
+            self._kpi_queue.put_nowait(data)
+        except queue.Full:
+            self.log.warning("KPI data queue is full, skipping datapoint")
 
 
 class DatapointSerializerNF(object):
@@ -385,9 +535,12 @@ class DatapointSerializerNF(object):
         super(DatapointSerializerNF, self).__init__()
         self.owner = owner
         self.multi = 1000  # multiplier factor for reporting
+        self.batch_size = 2000  # max metrics per API request (approximately)
+        self._last_cumulative = {}  # label -> {percentile: last sent value}
+        self._label_tags = {}  # label -> attributes dict, read-only and shared by all its metrics
         self.log = logging.getLogger(self.__class__.__name__)
 
-    def get_kpi_body(self, data_buffer, tags, is_final):
+    def iter_kpi_batches(self, data_buffer, is_final, batch_size=None):
         # - reporting format:
         #   {labels: <data>,    # see below
         #    sourceID: <id of BlazeMeterClient object>,
@@ -397,82 +550,170 @@ class DatapointSerializerNF(object):
         #
         # - elements of 'intervals' are described in __get_interval()
         #   every interval contains info about response codes have gotten on it.
+        #
+        # Metrics are yielded in lists of about batch_size items (a batch can end
+        # in the middle of a datapoint), so the whole buffer is never held as metric
+        # dicts at once. They carry only per-metric
+        # attributes (label, rc), tags common for the test go with to_json().
+        if not data_buffer:
+            return
+
+        batch_size = batch_size or self.batch_size
         nr_metrics = []
+        data_buffer = self._merge_buffer(data_buffer)
+
+        # buffer is in aggregator order, so its ends are the earliest and the latest points
+        owner = self.owner
+        first_ts = data_buffer[0][DataPoint.TIMESTAMP]
+        last_ts = data_buffer[-1][DataPoint.TIMESTAMP]
+        if first_ts < owner.first_ts:
+            owner.first_ts = first_ts
+        if last_ts > owner.last_ts:
+            owner.last_ts = last_ts
+
+        multi = self.multi
+        label_tags = self._label_tags
+        convert_current = self.__convert_current_data
+        convert_cumulative = self.__convert_cumulative_data
+
+        # fill 'Timeline Report' tab with intervals data
+        # intervals are received in the additive way
+        for dpoint in data_buffer:
+            time_stamp = dpoint[DataPoint.TIMESTAMP] * multi
+            for label, kpi_set in dpoint[DataPoint.CURRENT].items():
+                nrtags = label_tags.get(label) or label_tags.setdefault(label, {'label': label or 'OVERALL'})
+                nr_batch = convert_current(kpi_set, time_stamp, nrtags)
+                nr_metrics.extend(nr_batch)
+                if len(nr_metrics) >= batch_size:
+                    self.log.debug("Metrics in batch: %d", len(nr_metrics))
+                    yield nr_metrics
+                    nr_metrics = []
+
+            for label, kpi_set in dpoint[DataPoint.CUMULATIVE].items():
+                nrtags = label_tags.get(label) or label_tags.setdefault(label, {'label': label or 'OVERALL'})
+                nr_batch_cumulative = convert_cumulative(kpi_set, time_stamp, nrtags, label, is_final)
+                nr_metrics.extend(nr_batch_cumulative)
+                if len(nr_metrics) >= batch_size:
+                    self.log.debug("Metrics in batch: %d", len(nr_metrics))
+                    yield nr_metrics
+                    nr_metrics = []
+
+        if nr_metrics:
+            self.log.debug("Metrics in batch: %d", len(nr_metrics))
+            yield nr_metrics
+
+    def forget_cumulative(self):
+        """ Send every cumulative value next time, as if nothing was sent before """
+        self._last_cumulative.clear()
+
+    @staticmethod
+    def to_json(metrics, tags):
+        """
+        Metric API request body for a batch from iter_kpi_batches(),
+        tags go once into common attributes instead of every metric
+        :rtype: bytes
+        """
+        return orjson.dumps([{'common': {'attributes': tags}, 'metrics': metrics}], option=orjson.OPT_NON_STR_KEYS)
 
-        if data_buffer:
-            self.owner.first_ts = min(self.owner.first_ts, data_buffer[0][DataPoint.TIMESTAMP])
-            self.owner.last_ts = max(self.owner.last_ts, data_buffer[-1][DataPoint.TIMESTAMP])
-
-            # fill 'Timeline Report' tab with intervals data
-            # intervals are received in the additive way
-            for dpoint in data_buffer:
-                time_stamp = dpoint[DataPoint.TIMESTAMP]
-                for label, kpi_set in dpoint[DataPoint.CURRENT].items():
-                    nrtags = copy.deepcopy(tags)
-                    nrtags.update({'label': label or 'OVERALL'})
-                    nr_batch = self.__convert_current_data(kpi_set, time_stamp * self.multi, nrtags)
-                    nr_metrics.extend(nr_batch)
-
-                    self.log.debug("Current metrics in batch: %d", len(nr_batch))
-
-                for label, kpi_set in dpoint[DataPoint.CUMULATIVE].items():
-                    nrtags = copy.deepcopy(tags)
-                    nrtags.update({'label': label or 'OVERALL'})
-                    nr_batch_cumulative = self.__convert_cumulative_data(kpi_set, time_stamp * self.multi, nrtags)
-                    nr_metrics.extend(nr_batch_cumulative)
-
-                    self.log.debug("Cumulative metrics in batch: %d", len(nr_batch))
-
-        return nr_metrics
+    @staticmethod
+    def _merge_buffer(data_buffer):
+        """
+        Combine datapoints with the same timestamp into one, so every (timestamp, label)
+        pair is serialized once. Buffer order is kept. Current KPIs are merged per label,
+        cumulative ones are taken from the latest point as they already include earlier ones.
 
+        :type data_buffer: list[DataPoint]
+        :rtype: list[DataPoint]
+        """
+        merged = {}
+        copied = set()
+        for dpoint in data_buffer:
+            time_stamp = dpoint[DataPoint.TIMESTAMP]
+            if time_stamp not in merged:
+                merged[time_stamp] = dpoint
+                continue
+
+            if time_stamp not in copied:
+                # don't modify points we got from aggregator, other listeners share them
+                merged[time_stamp] = copy.deepcopy(merged[time_stamp])
+                copied.add(time_stamp)
+
+            target = merged[time_stamp]
+            current = target[DataPoint.CURRENT]
+            for label, kpi_set in dpoint[DataPoint.CURRENT].items():
+                if label in current:
+                    current[label].merge_kpis(kpi_set, dpoint[DataPoint.SOURCE_ID])
+                else:
+                    current[label] = copy.deepcopy(kpi_set)
+
+            # merging cumulative sets would count the same samples twice
+            target[DataPoint.CUMULATIVE] = dpoint[DataPoint.CUMULATIVE]
+
+        if not copied:
+            return data_buffer
+
+        for time_stamp in copied:
+            for kpi_set in merged[time_stamp][DataPoint.CURRENT].values():
+                kpi_set.recalculate()
+
+        return list(merged.values())
 
     def __convert_current_data(self, item, timestamp, nrtags):
+        multi = self.multi
+        names = _PCT_NAME
+        perc = item[KPISet.PERCENTILES]
+        rcodes = item[KPISet.RESP_CODES]
 
         # Overall stats : RPS, Threads, procentiles and mix/man/avg
-        tmin = int(self.multi * item[KPISet.PERCENTILES]["0.0"]) if "0.0" in item[KPISet.PERCENTILES] else 0
-        tmax = int(self.multi * item[KPISet.PERCENTILES]["100.0"]) if "100.0" in item[KPISet.PERCENTILES] else 0
-        tavg = self.multi * item[KPISet.AVG_RESP_TIME]
-        tlat = self.multi * item[KPISet.AVG_LATENCY]
-        tconn = self.multi * item[KPISet.AVG_CONN_TIME]
-
-        nrtags["timestamp"] = timestamp
-        self.log.debug("Timestamp in data convertion: %d", timestamp)
-
-        data = [
-            GaugeMetric('bztRPS', item[KPISet.SAMPLE_COUNT], nrtags, end_time_ms=timestamp),
-            GaugeMetric('bztThreads', item[KPISet.CONCURRENCY], nrtags, end_time_ms=timestamp),
-            GaugeMetric('bztFailures', item[KPISet.FAILURES], nrtags, end_time_ms=timestamp),
-            GaugeMetric('bztmin', tmin, nrtags, end_time_ms=timestamp),
-            GaugeMetric('bztmax', tmax, nrtags, end_time_ms=timestamp),
-            GaugeMetric('bztavg', tavg, nrtags, end_time_ms=timestamp),
-            GaugeMetric('bztlat', tlat, nrtags, end_time_ms=timestamp),
-            GaugeMetric('bztconn', tconn, nrtags, end_time_ms=timestamp)
-        ]
-
-        for p in item[KPISet.PERCENTILES]:
-            tperc = int(self.multi * item[KPISet.PERCENTILES][p])
-            data.append(GaugeMetric('bztp' + p, tperc, nrtags, end_time_ms=timestamp))
+        tmin = perc.get("0.0")
+        tmin = int(multi * tmin) if tmin is not None else 0
+        tmax = perc.get("100.0")
+        tmax = int(multi * tmax) if tmax is not None else 0
+        tavg = multi * item[KPISet.AVG_RESP_TIME]
+        tlat = multi * item[KPISet.AVG_LATENCY]
+        tconn = multi * item[KPISet.AVG_CONN_TIME]
+
+        # metrics in NewRelic Metric API format, all of them share nrtags dict
+        data = [{'name': name, 'type': 'gauge', 'value': value, 'timestamp': timestamp, 'attributes': nrtags}
+                for name, value in (
+                    ('bztRPS', item[KPISet.SAMPLE_COUNT]),
+                    ('bztThreads', item[KPISet.CONCURRENCY]),
+                    ('bztFailures', item[KPISet.FAILURES]),
+                    ('bztmin', tmin),
+                    ('bztmax', tmax),
+                    ('bztavg', tavg),
+                    ('bztlat', tlat),
+                    ('bztconn', tconn))]
+
+        data.extend([{'name': names.get(p) or names.setdefault(p, 'bztp' + p), 'type': 'gauge',
+                      'value': int(multi * v), 'timestamp': timestamp, 'attributes': nrtags}
+                     for p, v in perc.items()])
 
         # Detailed info : Error
-        for rcode in item[KPISet.RESP_CODES]:
-            error_tags = copy.deepcopy(nrtags)
-            error_tags['rc'] = rcode
-            rcnt = item[KPISet.RESP_CODES][rcode]
-            data.append(GaugeMetric('bztcode', rcnt, error_tags, end_time_ms=timestamp))
+        # attributes are kept by reference until the batch is sent, so every response
+        # code needs its own dict - mutating a shared one would rewrite 'rc' on all metrics
+        data.extend([{'name': 'bztcode', 'type': 'gauge', 'value': rcnt, 'timestamp': timestamp,
+                      'attributes': {**nrtags, 'rc': rcode}}
+                     for rcode, rcnt in rcodes.items()])
 
         return data
 
-    def __convert_cumulative_data(self, item, timestamp, nrtags):
+    def __convert_cumulative_data(self, item, timestamp, nrtags, label, is_final=False):
         # Cumulative stats : Procentiles only
-
-        nrtags["timestamp"] = timestamp
-        self.log.debug("Timestamp in data convertion: %d", timestamp)
+        # Only changed values are sent, the last report sends all of them.
 
         data = []
-
-        for p in item[KPISet.PERCENTILES]:
-            tperc = int(self.multi * item[KPISet.PERCENTILES][p])
-            data.append(GaugeMetric('bztpc' + p, tperc, nrtags, end_time_ms=timestamp))
+        multi = self.multi
+        names = _PCTC_NAME
+        prev = self._last_cumulative.setdefault(label, {})
+
+        for p, v in item[KPISet.PERCENTILES].items():
+            tperc = int(multi * v)
+            if not is_final and prev.get(p) == tperc:
+                continue
+            prev[p] = tperc
+            name = names.get(p) or names.setdefault(p, 'bztpc' + p)
+            data.append({'name': name, 'type': 'gauge', 'value': tperc, 'timestamp': timestamp, 'attributes': nrtags})
 
         return data
 
@@ -481,30 +722,40 @@ class DashboardManager:
 
     ### Client initialization 
     def __init__(self) -> None:
-        self.client = None
+        self.http_session = None
+        self.headers = {}
         self.api_token = None
         self.log = logging.getLogger(self.__class__.__name__)
         self.api_endpoint = 'https://api.newrelic.com/graphql'
         self.api_token = None
         self.static_report = 'false'
         self.template = ''
+        self.template_obj = string.Template('')
         self.dashboard_guid = ''
         self.retry_limit = 5
         self.account_id = ''
+        self.cache_file = os.path.join(os.path.expanduser('~'), '.bzt', 'newrelic_dashboard_cache.json')
+        self.cache_ttl = 3600  # sec, 0 disables the cache
 
     def client_init(self):
 
-        headers = {
+        self.headers = {
             'API-Key': self.api_token,
             'Content-Type': 'application/json'
         }
 
-        try:
-            self.client = GraphqlClient(endpoint=self.api_endpoint, headers=headers)
-        except Exception:
-            self.log.error('Error in NR Client initialization: %s', traceback.format_exc())
-            self.log.info('Exiting...')
-            exit(0)
+        # one kept-alive connection pool for all GraphQL calls and the PDF download
+        self.http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=0)
+        self.http_session.mount('https://', adapter)
+        self.http_session.mount('http://', adapter)
+
+    def execute(self, query):
+        """ Run GraphQL query, returns decoded JSON response """
+        response = self.http_session.post(self.api_endpoint, data=orjson.dumps({'query': query, 'variables': {}}),
+                                          headers=self.headers)
+        response.raise_for_status()
+        return orjson.loads(response.content)
 
         ### Check authorization
 
@@ -520,10 +771,16 @@ class DashboardManager:
         }
         '''
 
+        token_owner = self._cache_get('token_owner')
+        if token_owner:
+            self.log.info('Auth is cached, token from %s ', token_owner)
+            return True
+
         try:
-            data = self.client.execute(query=query)
+            data = self.execute(query)
             token_owner = data['data']['actor']['user']['name']
             self.log.info('Auth is successful, token from %s ', token_owner)
+            self._cache_set(token_owner=token_owner)
             return True
         except Exception as e:
             self.log.error('Something wrong with API : %s', e)
@@ -552,7 +809,7 @@ class DashboardManager:
         }
         ''' % search_query
 
-        data = self.client.execute(query=search_dashboard)
+        data = self.execute(search_dashboard)
         try:
             if data['data']['actor']['entitySearch']['count'] > 0:
                 self.log.info('Dashboard found:  %s ', f'Load Tests [{project}]')
@@ -564,16 +821,19 @@ class DashboardManager:
         except Exception as e:
             self.log.warning('Problem with GraphQL dashboard response, %s' % e)
 
+    def set_template(self, template):
+        """ Keep dashboard template, with placeholders turned into string.Template fields once """
+        self.template = template
+        self.template_obj = string.Template(template.replace('$', '$$').replace(
+            'PROJECT_PLACE_HOLDER', '${project}').replace(
+            'ACCOUNT_PLACE_HOLDER', '${account}'))
+
     def dashboard_create(self, project):
-        dashboard_create_query = self.template.replace(
-            'PROJECT_PLACE_HOLDER', project).replace(
-            'ACCOUNT_PLACE_HOLDER', str(self.account_id)
-        )
+        dashboard_create_query = self.template_obj.substitute(project=project, account=str(self.account_id))
         try:
-            data = self.client.execute(query=dashboard_create_query)
+            data = self.execute(dashboard_create_query)
             self.log.info(f'Dashboard for project "{project}" created, sending the link')
             guid = data['data']['dashboardCreate']['entityResult']['guid']
-            time.sleep(3)
             search_dashboard_query = '''
             {
             actor {
@@ -591,29 +851,35 @@ class DashboardManager:
             }
             ''' % guid
 
-            retry = self.retry_limit
+            attempt = 0
 
             while True:
                 try:
-                    data = self.client.execute(query=search_dashboard_query)
+                    data = self.execute(search_dashboard_query)
                     permalink = data['data']['actor']['entitySearch']['results']['entities'][0]['permalink']
                     self.dashboard_guid = data['data']['actor']['entitySearch']['results']['entities'][0]['guid']
                     return permalink
                 except Exception:
-                    if retry > 0:
-                        retry -= 1
-                        self.log.warning('Permalink is not ready yet, sleeping 10 sec')
-                        time.sleep(10)
+                    if attempt < self.retry_limit:
+                        delay = self._poll_delay(attempt)
+                        attempt += 1
+                        self.log.warning('Permalink is not ready yet, sleeping %.1f sec', delay)
+                        time.sleep(delay)
                         continue
                     self.log.warning('Permalink is not ready yet, failing back to default link')
-                    return "https://one.newrelic.com/dashboards"
+                    return DEFAULT_DASHBOARD_URL
 
                 ### If permalink is not ready, skipping whole url generation.
-        except BaseException:
+        except Exception:
             self.log.warning(f'Dashboard for project {project} can not be created, possible problems are: ')
             self.log.warning('Template rendering, API access, unexpected letters in project, or account-id.')
             self.log.warning('Check the documentation. Meanwhile sending default link for NewRelic dashboards')
-            return "https://one.newrelic.com/dashboards"
+            return DEFAULT_DASHBOARD_URL
+
+    @staticmethod
+    def _poll_delay(attempt):
+        """ Exponential delay 1, 2, 4, 8, 16 sec with jitter, between polls of not-yet-ready API objects """
+        return min(16, 2 ** attempt) * (0.5 + random.random() / 2)
 
     def create_pdf(self, time_start, time_end):
         self.log.info('PDF report generation is coming. Waiting all data in place.')
@@ -636,24 +902,28 @@ class DashboardManager:
         ''' % (self.dashboard_guid, time_start, time_end)
 
         try:
-            retry = self.retry_limit
-            data = self.client.execute(query=pdf_link_query)
+            data = self.execute(pdf_link_query)
             pdf_link = data['data']['dashboardCreateSnapshotUrl']
-            while pdf_link is None and retry != 0:
-                self.log.warning('Problem with PDF link generating, denied of service, retrying...')
-                retry -= 1
+            for attempt in range(self.retry_limit):
+                if pdf_link is not None:
+                    break
+                delay = self._poll_delay(attempt)
+                self.log.warning('Problem with PDF link generating, denied of service, retrying in %.1f sec...', delay)
+                time.sleep(delay)
+                data = self.execute(pdf_link_query)
+                pdf_link = data['data']['dashboardCreateSnapshotUrl']
 
             self.log.info('PDF report link %s' % pdf_link)
-            r = requests.get(pdf_link, allow_redirects=True)
+            r = self.http_session.get(pdf_link, allow_redirects=True)
             r.raise_for_status()
             try:
                 report_filename = f'static_report_{date_time}.pdf'
                 with open(report_filename, 'wb') as f:
                     f.write(r.content)
                 self.log.info('Static report saved as %s' % report_filename)
-            except BaseException:
+            except Exception:
                 self.log.warning('Problem with PDF retrieving, network or firewall problem.')
-        except BaseException:
+        except Exception:
             self.log.warning('Problem with PDF link generating, denied of service')
 
     def get_account_id(self):
@@ -666,12 +936,54 @@ class DashboardManager:
             }
             }
         '''
+        first_account_id = self._cache_get('account_id')
+        if first_account_id:
+            self.log.info(f'Using cached account {first_account_id} as default, use account-id to redefine')
+            return first_account_id
+
         try:
-            data = self.client.execute(query=accounts_query)
+            data = self.execute(accounts_query)
             count = len(data['data']['actor']['accounts'])
             first_account_id = data['data']['actor']['accounts'][0]['id']
             self.log.info(f'Found {count} accounts, will use {first_account_id} as default, use account-id to redefine')
+            self._cache_set(account_id=first_account_id)
             return first_account_id
         except Exception as e:
             self.log.warning('Problem with GraphQL accounts response, %s' % e)
             return ''
+
+    ### Cache of near-static API responses (token owner, default account), shared between runs
+    def _cache_key(self):
+        return hashlib.sha256(f'{self.api_token}|{self.api_endpoint}'.encode('utf-8')).hexdigest()
+
+    def _cache_read(self):
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as handle:
+                cache = json.load(handle)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(cache, dict):
+            return {}
+        now = time.time()
+        return {key: entry for key, entry in cache.items()
+                if isinstance(entry, dict) and entry.get('expires_at', 0) > now}
+
+    def _cache_get(self, name):
+        if not self.api_token or not self.cache_ttl:
+            return None
+        return self._cache_read().get(self._cache_key(), {}).get(name)
+
+    def _cache_set(self, **values):
+        if not self.api_token or not self.cache_ttl:
+            return
+
+        cache = self._cache_read()
+        entry = cache.setdefault(self._cache_key(), {'expires_at': time.time() + self.cache_ttl})
+        entry.update(values)
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, 'w', encoding='utf-8') as handle:
+                json.dump(cache, handle)
+        except OSError as e:
+            self.log.debug('Problem with dashboard cache file %s: %s', self.cache_file, e)
@@ -15,7 +15,6 @@ setup(
     install_requires=[
         'bzt',
         'requests',
-        'newrelic-telemetry-sdk',
-        'python_graphql_client'],
+        'orjson'],
     include_package_data=True,
 )
\ No newline at end of file